@@ -1,8 +1,39 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
 import numpy as np
 from cxotime import CxoTime
 from acis_thermal_check.utils import mylog
 
 
+# Edges of the TSC position ranges for each instrument, and the
+# instrument in the focal plane between each pair of edges. The ranges
+# use the max and min hard stop locations, inclusive at both ends, so
+# the upper edge of each range is the next float above its last value.
+_FP_EDGES = np.array([-104362.0, np.nextafter(-86148.0, np.inf),
+                      -86147.0, np.nextafter(-20000.0, np.inf),
+                      70736.0, np.nextafter(82108.0, np.inf),
+                      82109.0, np.nextafter(104839.0, np.inf)])
+_FP_LABELS = np.array(['launchlock', 'HRC-S', 'launchlock', 'HRC-I',
+                       'launchlock', 'ACIS-S', 'launchlock', 'ACIS-I',
+                       'launchlock'])
+
+
+def who_in_fp_array(simpos):
+    """
+    Vectorized version of who_in_fp: returns an array of strings
+    telling you which instrument is in the Focal Plane for each
+    TSC position in the input array.
+
+          input: - TSC positions (simpos) - array of INTEGERS
+
+          output - Array of strings indicating what is in the focal plane
+    """
+    return _FP_LABELS[np.searchsorted(_FP_EDGES, simpos, side='right')]
+
+
 def who_in_fp(simpos=80655):
     """
     Returns a string telling you which instrument is in
@@ -23,21 +54,175 @@ def who_in_fp(simpos=80655):
                    "HRC-I"
                    "HRC-S"
     """
-    is_in_the_fp = 'launchlock'
-
-    #  Set the value of is_in_the_fp to the appropriate value. It will default
-    #  to "launchlock" if no value matches
-    if 104839 >= simpos >= 82109:
-        is_in_the_fp = 'ACIS-I'
-    elif 82108 >= simpos >= 70736:
-        is_in_the_fp = 'ACIS-S'
-    elif -20000 >= simpos >= -86147:
-        is_in_the_fp = 'HRC-I'
-    elif -86148 >= simpos >= -104362:
-        is_in_the_fp = 'HRC-S'
-
     #  return the string indicating which instrument is in the Focal Plane
-    return is_in_the_fp
+    return str(who_in_fp_array(simpos))
+
+
+# Maximum number of obsids and sequence numbers to request from
+# the obscat in a single query
+OBSID_CHUNK_SIZE = 100
+SEQ_CHUNK_SIZE = 200
+
+# Names of the obscat columns giving the status of each CCD
+CCD_COLS = tuple(f"{a}{i}" for a, r in zip(["I", "S"], [range(4), range(6)])
+                 for i in r)
+
+# Obscat columns used by fetch_ocat_data for each kind of query. Only
+# these are read, so that the other (often blank) columns cannot stop
+# the tables from separate chunks from being stacked.
+OCAT_COLS = {"obsid": ["OBSID", "SEQ_NUM", "GRAT", "S3", *CCD_COLS,
+                       "DROPPED_CHIP_CNT", "EST_CNT_RATE"],
+             "seqNum": ["SEQ_NUM", "APP_EXP"]}
+
+# Obscat columns which must be read as text
+OCAT_TEXT_COLS = CCD_COLS + ("S3", "GRAT")
+
+# Directory where the results of obscat queries are cached
+OCAT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache",
+                              "acisfp_check", "ocat")
+
+# Maximum number of obscat queries which are run at the same time
+OCAT_MAX_WORKERS = 8
+
+# Shared HTTP session for obscat queries, created on first use so that
+# the connection pool is kept warm between requests. The session is
+# shared by the worker threads in _fetch_ocat_tables: they only issue
+# stateless GETs (no cookies, auth, or changes to the session's
+# settings), and the underlying urllib3 connection pool is thread-safe
+# and sized so that each worker can hold its own connection.
+_OCAT_SESSION = None
+_OCAT_SESSION_LOCK = threading.Lock()
+
+
+def _get_ocat_session():
+    """
+    Return the shared requests.Session used to query the obscat.
+    """
+    global _OCAT_SESSION
+    with _OCAT_SESSION_LOCK:
+        if _OCAT_SESSION is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            session.mount("https://",
+                          HTTPAdapter(pool_connections=4,
+                                      pool_maxsize=OCAT_MAX_WORKERS))
+            _OCAT_SESSION = session
+    return _OCAT_SESSION
+
+
+def _fetch_ocat_table(urlbase, key, ids):
+    """
+    Fetch a single table from the obscat for a list of ids (obsids
+    or sequence numbers, depending on *key*). Returns None if the
+    table could not be retrieved.
+    """
+    import requests
+    from ska_helpers.retry import retry_call
+    from astropy.io import ascii
+    params = {key: ",".join(ids)}
+    try:
+        resp = retry_call(_get_ocat_session().get, [urlbase],
+                          {"params": params, "timeout": 30},
+                          tries=4, delay=1)
+    except (requests.ConnectionError, requests.Timeout):
+        return None
+    if not resp.ok:
+        return None
+    return ascii.read(resp.text, header_start=0, data_start=2,
+                      include_names=OCAT_COLS.get(key))
+
+
+def _fetch_ocat_tables(urlbase, key, id_chunks):
+    """
+    Fetch tables from the obscat for several chunks of ids
+    concurrently and stack them into a single table. Returns
+    None if any of the tables could not be retrieved.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from astropy.table import vstack
+    from astropy.table.np_utils import TableMergeError
+    if len(id_chunks) == 0:
+        id_chunks = [[]]
+    max_workers = min(len(id_chunks), OCAT_MAX_WORKERS)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tables = list(executor.map(
+            lambda ids: _fetch_ocat_table(urlbase, key, ids), id_chunks))
+    if any(t is None for t in tables):
+        return None
+    if len(tables) == 1:
+        return tables[0]
+    # Each chunk is parsed on its own, so a text column which is blank
+    # for every row of a chunk (e.g. the CCD columns for a chunk of only
+    # HRC obsids) can be read as a different type there. Make the text
+    # columns we read strings everywhere so that the chunks can be stacked.
+    for t in tables:
+        for col in OCAT_TEXT_COLS:
+            if col in t.colnames:
+                t[col] = t[col].astype("str")
+    try:
+        return vstack(tables)
+    except (TableMergeError, TypeError):
+        return None
+
+
+def _ocat_cache_file(obsid_list):
+    """
+    Return the path of the on-disk cache file for the obscat data
+    of a list of obsids (as strings), keyed by a hash of the set of
+    obsids.
+    """
+    key = ",".join(sorted(obsid_list)).encode("utf-8")
+    digest = hashlib.blake2b(key, digest_size=16).hexdigest()
+    return os.path.join(OCAT_CACHE_DIR, f"{digest}.pkl")
+
+
+def _ocat_cache_ttl():
+    """
+    Return the lifetime of the obscat cache in seconds, which is set by
+    the ACISFP_OCAT_CACHE_TTL environment variable. The cache is off
+    unless this is set to a value greater than zero.
+    """
+    ttl = os.environ.get("ACISFP_OCAT_CACHE_TTL")
+    if ttl is None:
+        return 0.0
+    try:
+        return float(ttl)
+    except ValueError:
+        mylog.warning(f"Invalid value ACISFP_OCAT_CACHE_TTL={ttl!r}, "
+                      f"the Obscat cache will not be used.")
+        return 0.0
+
+
+def _read_ocat_cache(cache_file, ttl):
+    """
+    Return the cached obscat data in *cache_file*, or None if there
+    is no usable cache file or it is older than *ttl* seconds.
+    """
+    try:
+        if time.time() - os.path.getmtime(cache_file) > ttl:
+            return None
+        with open(cache_file, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        # A missing, truncated, or incompatible cache file (e.g. written
+        # by another version of NumPy or AstroPy) is just a cache miss
+        return None
+
+
+def _write_ocat_cache(cache_file, table_dict):
+    """
+    Write the obscat data to *cache_file*. Failing to write the cache
+    is not an error.
+    """
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump(table_dict, f)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        mylog.warning(f"Could not write the Obscat cache file {cache_file}.")
 
 
 def fetch_ocat_data(obsid_list):
@@ -55,9 +240,6 @@ def fetch_ocat_data(obsid_list):
     -------
     A dict of NumPy arrays of the above properties.
     """
-    import requests
-    from ska_helpers.retry import retry_call
-    from astropy.io import ascii
     warn = "Could not get the table from the Obscat to " \
            "determine which observations can go to -109 C. " \
            "Any violations of eligible observations should " \
@@ -66,65 +248,68 @@ def fetch_ocat_data(obsid_list):
     # asks for text formatting so that the output can be ingested into
     # an AstroPy table.
     urlbase = "https://cda.harvard.edu/srservices/ocatDetails.do?format=text"
-    obsid_list = ",".join([str(obsid) for obsid in obsid_list])
-    params = {"obsid": obsid_list}
-    # First fetch the information from the obsid itself
-    got_table = True
-    try:
-        resp = retry_call(requests.get, [urlbase], {"params": params}, 
-                          tries=4, delay=1)
-    except requests.ConnectionError:
-        got_table = False
-    else:
-        if not resp.ok:
-            got_table = False
-    if got_table:
-        tab = ascii.read(resp.text, header_start=0, data_start=2)
+    obsid_list = list(dict.fromkeys([str(obsid) for obsid in obsid_list]))
+    # Use the cached data for this set of obsids if we have it
+    cache_ttl = _ocat_cache_ttl()
+    cache_file = _ocat_cache_file(obsid_list)
+    if cache_ttl > 0.0:
+        table_dict = _read_ocat_cache(cache_file, cache_ttl)
+        if table_dict is not None:
+            return table_dict
+    # First fetch the information from the obsids themselves, in chunks
+    # to keep the query URLs at a reasonable length. Each obsid is only
+    # requested once so that chunks do not return duplicate rows.
+    obsid_chunks = [obsid_list[i:i+OBSID_CHUNK_SIZE]
+                    for i in range(0, len(obsid_list), OBSID_CHUNK_SIZE)]
+    tab = _fetch_ocat_tables(urlbase, "obsid", obsid_chunks)
+    if tab is not None:
         tab.sort("OBSID")
         # We figure out the CCD count from the table by finding out
         # which ccds were on, optional, or dropped, and then
         # subtracting off the dropped chip count entry in the table
-        ccd_count = np.zeros(tab["S3"].size, dtype='int')
-        for a, r in zip(["I", "S"], [range(4), range(6)]):
-            for i in r:
-                ccd = np.ma.filled(tab[f"{a}{i}"].data)
-                ccd_count += (ccd == "Y").astype('int')
-                ccd_count += (ccd == "D").astype('int')
-                ccd_count += np.char.startswith(ccd, "O").astype('int')
+        ccds = np.stack([np.ma.filled(tab[col].data).astype("str")
+                         for col in CCD_COLS])
+        ccd_on = (ccds == "Y") | (ccds == "D") | np.char.startswith(ccds, "O")
+        ccd_count = ccd_on.sum(axis=0).astype('int')
         ccd_count -= tab["DROPPED_CHIP_CNT"].data.astype('int')
         # Now we have to find all of the obsids in each sequence and then
         # compute the complete exposure for each sequence
         seq_nums = list(tab["SEQ_NUM"].data.astype("str"))
-        seq_num_list = ",".join([seq_num for seq_num in seq_nums if seq_num != " "])
+        # Only ask for each sequence once, preserving the original order
+        seq_num_list = list(dict.fromkeys(
+            [seq_num for seq_num in seq_nums if seq_num != " "]))
         obsids = tab["OBSID"].data.astype("int")
         cnt_rate = tab["EST_CNT_RATE"].data.astype("float64")
-        params = {"seqNum": seq_num_list}
-        got_seq_table = True
-        try:
-            resp = retry_call(requests.get, [urlbase], {"params": params},
-                              tries=4, delay=1)
-        except requests.ConnectionError:
-            got_seq_table = False
-        else:
-            if not resp.ok:
-                got_seq_table = False
-        if not got_seq_table:
+        # The sequence queries are independent of each other, so they are
+        # split into chunks which are fetched concurrently
+        seq_chunks = [seq_num_list[i:i+SEQ_CHUNK_SIZE]
+                      for i in range(0, len(seq_num_list), SEQ_CHUNK_SIZE)]
+        tab_seq = _fetch_ocat_tables(urlbase, "seqNum", seq_chunks)
+        if tab_seq is None:
             # We weren't able to get a valid sequence table for some
             # reason, so we cannot check for -109 data, but we proceed
             # with the rest of the review regardless
             mylog.warning(warn)
             return None
-        tab_seq = ascii.read(resp.text, header_start=0, data_start=2)
-        app_exp = np.zeros_like(cnt_rate)
-        for row in tab_seq:
-            i = seq_nums.index(str(row["SEQ_NUM"]))
-            app_exp[i] += np.float64(row["APP_EXP"])
+        # Map each sequence number to the first obsid row which has it
+        seq_index = {}
+        for i, seq_num in enumerate(seq_nums):
+            seq_index.setdefault(seq_num, i)
+        idx = np.fromiter((seq_index[seq_num] for seq_num in
+                           tab_seq["SEQ_NUM"].data.astype("str")),
+                          dtype=np.intp, count=len(tab_seq))
+        seq_exp = np.ma.filled(tab_seq["APP_EXP"].data.astype("float64"),
+                               np.nan)
+        app_exp = np.zeros(len(cnt_rate))
+        np.add.at(app_exp, idx, seq_exp)
         app_exp *= 1000.0
         table_dict = {"obsid": np.array(obsids),
                       "grating": tab["GRAT"].data,
                       "ccd_count": ccd_count,
                       "S3": np.ma.filled(tab["S3"].data),
                       "num_counts": cnt_rate*app_exp}
+        if cache_ttl > 0.0:
+            _write_ocat_cache(cache_file, table_dict)
     else:
         # We weren't able to get a valid table for some reason, so
         # we cannot check for -109 data, but we proceed with the
@@ -134,6 +319,21 @@ def fetch_ocat_data(obsid_list):
     return table_dict
 
 
+# Power commands which mark the start of an observation interval, the
+# start of science, and the stop of science
+POW_CMDS = frozenset(('WSPOW00000', 'WSVIDALLDN'))
+XTZ_CMDS = frozenset(('XTZ0000005', 'XCZ0000005'))
+AA_CMDS = frozenset(('AA00000000',))
+
+# Integer tags for the above power commands, used to classify the states
+POW_TAG, XTZ_TAG, AA_TAG = 1, 2, 3
+_POWER_CMD_TAGS = {cmd: tag
+                   for cmds, tag in ((POW_CMDS, POW_TAG),
+                                     (XTZ_CMDS, XTZ_TAG),
+                                     (AA_CMDS, AA_TAG))
+                   for cmd in cmds}
+
+
 def find_obsid_intervals(cmd_states):
     """
     User reads the SKA commanded states archive, via
@@ -186,29 +386,43 @@ def find_obsid_intervals(cmd_states):
 
     obsid_interval_list = []
 
-    for eachstate in cmd_states:
-
-        # Make sure we skip maneuver obsids explicitly
-        if 60000 > eachstate['obsid'] >= 38001:
-            continue
-
-        pow_cmd = eachstate['power_cmd']
+    # Only the states with one of the power commands we are looking for
+    # can change anything below, so find those first and only loop over
+    # them. Make sure we skip maneuver obsids explicitly.
+    # Each distinct power command is only classified once.
+    uniq_cmds, inv = np.unique(np.asarray(cmd_states['power_cmd']),
+                               return_inverse=True)
+    tag_map = np.array([_POWER_CMD_TAGS.get(str(cmd), 0)
+                        for cmd in uniq_cmds], dtype=np.int8)
+    tags = tag_map[inv.reshape(-1)]
+    state_obsids = np.asarray(cmd_states['obsid'])
+    skip = (state_obsids >= 38001) & (state_obsids < 60000)
+    markers = np.flatnonzero((tags > 0) & ~skip)
+
+    # Figure out who is in the focal plane for all of the XTZ states at once
+    xtz_rows = markers[tags[markers] == XTZ_TAG]
+    simpos = np.asarray(cmd_states['simpos'])[xtz_rows]
+    instruments = dict(zip(xtz_rows, who_in_fp_array(simpos)))
+
+    for i in markers:
+
+        eachstate = cmd_states[i]
+        tag = tags[i]
 
         # is this the first WSPOW of the interval?
-        if pow_cmd in ['WSPOW00000', 'WSVIDALLDN'] and not firstpow:
+        if tag == POW_TAG and not firstpow:
             firstpow = True
             datestart = eachstate['datestart']
             tstart = eachstate['tstart']
 
         # Process the first XTZ0000005 line you see
-        if pow_cmd in ['XTZ0000005', 'XCZ0000005'] and \
-                (xtztime is None and firstpow):
+        if tag == XTZ_TAG and (xtztime is None and firstpow):
             xtztime = eachstate['tstart']
             # MUST fix the instrument now
-            instrument = who_in_fp(eachstate['simpos'])
+            instrument = str(instruments[i])
 
         # Process the first AA00000000 line you see
-        if pow_cmd == 'AA00000000' and firstpow:
+        if tag == AA_TAG and firstpow:
             datestop = eachstate['datestop']
             tstop = eachstate['tstop']
 
@@ -233,25 +447,30 @@ def find_obsid_intervals(cmd_states):
             firstpow = False
             xtztime = None
 
-    # End of LOOP for eachstate in cmd_states:
+    # End of LOOP for marker states in cmd_states:
 
-    # sort based on obsid
-    obsid_interval_list.sort(key=lambda x: x["obsid"])
-    # Now we add the stuff we get from ocat_data
-    obsids = [e["obsid"] for e in obsid_interval_list]
-    ocat_data = fetch_ocat_data(obsids)
+    # Now we add the stuff we get from ocat_data. The obscat doesn't have
+    # info for cold ECS observations, so we don't ask for them.
+    obsids = [e["obsid"] for e in obsid_interval_list if e["obsid"] <= 60000]
+    ocat_data = fetch_ocat_data(obsids) if len(obsids) > 0 else None
     if ocat_data is not None:
         ocat_keys = list(ocat_data.keys())
         ocat_keys.remove("obsid")
-        for i, obsid in enumerate(obsids):
-            # The obscat doesn't have info for cold ECS observations
-            if obsid > 60000:
+        ocat_cols = [ocat_data[key] for key in ocat_keys]
+        # Match up the obscat rows with the intervals by obsid. Cold ECS
+        # observations were not queried so they have no match.
+        ocat_index = {obsid: i for i, obsid in enumerate(ocat_data["obsid"])}
+        for eachobs in obsid_interval_list:
+            i = ocat_index.get(eachobs["obsid"])
+            if i is None:
                 continue
-            for key in ocat_keys:
-                obsid_interval_list[i][key] = ocat_data[key][i]
+            eachobs.update(zip(ocat_keys, [col[i] for col in ocat_cols]))
 
-    # re-sort based on tstart
-    obsid_interval_list.sort(key=lambda x: x["tstart"])
+    # sort based on tstart
+    tstarts = np.fromiter((e["tstart"] for e in obsid_interval_list),
+                          dtype=np.float64, count=len(obsid_interval_list))
+    order = np.argsort(tstarts, kind="stable")
+    obsid_interval_list = [obsid_interval_list[i] for i in order]
     return obsid_interval_list
 
 
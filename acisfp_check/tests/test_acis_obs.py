@@ -0,0 +1,204 @@
+from .. import acis_obs
+import numpy as np
+import os
+import pytest
+
+
+fp_cases = [(-104363, "launchlock"), (-104362, "HRC-S"),
+            (-86148, "HRC-S"), (-86147.5, "launchlock"),
+            (-86147, "HRC-I"), (-20000, "HRC-I"),
+            (-19999.5, "launchlock"), (-19999, "launchlock"),
+            (0, "launchlock"), (70735, "launchlock"),
+            (70736, "ACIS-S"), (75624, "ACIS-S"), (82108, "ACIS-S"),
+            (82108.5, "launchlock"), (82109, "ACIS-I"),
+            (92904, "ACIS-I"), (104839, "ACIS-I"),
+            (104840, "launchlock")]
+
+
+@pytest.mark.parametrize("simpos, instrument", fp_cases)
+def test_who_in_fp(simpos, instrument):
+    assert acis_obs.who_in_fp(simpos) == instrument
+
+
+def test_who_in_fp_array():
+    simpos, instruments = zip(*fp_cases)
+    assert list(acis_obs.who_in_fp_array(np.array(simpos))) == \
+        list(instruments)
+
+
+class _FakeResponse:
+    ok = True
+
+    def __init__(self, text):
+        self.text = text
+
+
+class _FakeSession:
+    # Returns tab-separated obscat text for each query, keyed by the
+    # comma-separated ids that were asked for
+    def __init__(self, key, colnames, rows):
+        self.key = key
+        self.colnames = colnames
+        self.rows = rows
+
+    def get(self, urlbase, params=None, timeout=None):
+        lines = ["\t".join(self.colnames),
+                 "\t".join("-" * len(c) for c in self.colnames)]
+        lines += ["\t".join(str(v) for v in row)
+                  for row in self.rows[params[self.key]]]
+        return _FakeResponse("\n".join(lines) + "\n")
+
+
+def test_fetch_ocat_tables_mixed_types(monkeypatch):
+    # The second chunk only has HRC obsids, so its CCD, S3 and TOO_TYPE
+    # columns are blank and get read as ints instead of strings. TOO_TYPE
+    # is not used, so it should not be read at all.
+    colnames = ["OBSID", "SEQ_NUM", "TARGET_NAME", "GRAT", "S3",
+                *acis_obs.CCD_COLS, "DROPPED_CHIP_CNT", "EST_CNT_RATE",
+                "TOO_TYPE"]
+    rows = {"1,2": [[1, 100, "Crab", "NONE", "Y", *["Y"]*4, *["N"]*6,
+                     0, 0.1, "DDT"],
+                    [2, 101, "Vela", "HETG", "Y", *["N"]*4, *["Y"]*6,
+                     1, 0.2, "FAST"]],
+            "3": [[3, 102, "M31", "NONE", "", *[""]*10, 0, 0.3, ""]]}
+    monkeypatch.setattr(acis_obs, "_get_ocat_session",
+                        lambda: _FakeSession("obsid", colnames, rows))
+    tab = acis_obs._fetch_ocat_tables("", "obsid", [["1", "2"], ["3"]])
+    assert tab.colnames == acis_obs.OCAT_COLS["obsid"]
+    assert list(tab["OBSID"]) == [1, 2, 3]
+    assert list(tab["S3"][:2]) == ["Y", "Y"]
+    assert tab["S3"].mask[2]
+    assert list(tab["GRAT"]) == ["NONE", "HETG", "NONE"]
+
+
+def test_fetch_ocat_tables_seq_chunks(monkeypatch):
+    # Only the sequence number and exposure are read from the sequence
+    # tables, so unrelated columns which are blank in one chunk don't
+    # stop them from being stacked
+    colnames = ["OBSID", "SEQ_NUM", "APP_EXP", "GRID_NAME", "RASTER_SCAN"]
+    rows = {"100,101": [[1, 100, 10.0, "grid1", "Y"],
+                        [2, 101, 20.0, "grid1", "N"]],
+            "102": [[3, 102, 30.0, "", ""]]}
+    monkeypatch.setattr(acis_obs, "_get_ocat_session",
+                        lambda: _FakeSession("seqNum", colnames, rows))
+    tab = acis_obs._fetch_ocat_tables("", "seqNum",
+                                      [["100", "101"], ["102"]])
+    assert tab.colnames == ["SEQ_NUM", "APP_EXP"]
+    assert list(tab["SEQ_NUM"]) == [100, 101, 102]
+    assert list(tab["APP_EXP"]) == [10.0, 20.0, 30.0]
+
+
+@pytest.fixture
+def ocat_cache(tmp_path, monkeypatch):
+    # Point the cache at a temporary directory and record any queries
+    # which would have gone to the obscat
+    monkeypatch.setattr(acis_obs, "OCAT_CACHE_DIR", str(tmp_path))
+    monkeypatch.delenv("ACISFP_OCAT_CACHE_TTL", raising=False)
+    queries = []
+
+    def _fetch_ocat_tables(urlbase, key, id_chunks):
+        queries.append(id_chunks)
+        return None
+
+    monkeypatch.setattr(acis_obs, "_fetch_ocat_tables", _fetch_ocat_tables)
+    cache_file = acis_obs._ocat_cache_file(["1", "2"])
+    acis_obs._write_ocat_cache(cache_file, {"obsid": np.array([1, 2])})
+    return cache_file, queries
+
+
+def test_ocat_cache_hit(ocat_cache, monkeypatch):
+    cache_file, queries = ocat_cache
+    monkeypatch.setenv("ACISFP_OCAT_CACHE_TTL", "3600")
+    ocat_data = acis_obs.fetch_ocat_data([2, 1])
+    assert list(ocat_data["obsid"]) == [1, 2]
+    assert queries == []
+
+
+def test_ocat_cache_miss(ocat_cache, monkeypatch):
+    cache_file, queries = ocat_cache
+    monkeypatch.setenv("ACISFP_OCAT_CACHE_TTL", "3600")
+    assert acis_obs.fetch_ocat_data([3]) is None
+    assert len(queries) == 1
+
+
+def test_ocat_cache_expired(ocat_cache, monkeypatch):
+    cache_file, queries = ocat_cache
+    monkeypatch.setenv("ACISFP_OCAT_CACHE_TTL", "3600")
+    old = os.path.getmtime(cache_file) - 7200.0
+    os.utime(cache_file, (old, old))
+    assert acis_obs.fetch_ocat_data([1, 2]) is None
+    assert len(queries) == 1
+
+
+@pytest.mark.parametrize("ttl", [None, "0", "-1", "one hour"])
+def test_ocat_cache_disabled(ocat_cache, monkeypatch, ttl):
+    cache_file, queries = ocat_cache
+    if ttl is not None:
+        monkeypatch.setenv("ACISFP_OCAT_CACHE_TTL", ttl)
+    assert acis_obs.fetch_ocat_data([1, 2]) is None
+    assert len(queries) == 1
+
+
+def test_ocat_cache_corrupt(ocat_cache, monkeypatch):
+    cache_file, queries = ocat_cache
+    monkeypatch.setenv("ACISFP_OCAT_CACHE_TTL", "3600")
+    with open(cache_file, "wb") as f:
+        f.write(b"not a pickle")
+    assert acis_obs.fetch_ocat_data([1, 2]) is None
+    assert len(queries) == 1
+
+
+def _obs(obsid, instrument, **ocat):
+    obs = {"obsid": obsid, "instrument": instrument}
+    obs.update(ocat)
+    return obs
+
+
+# Each case is an observation and which list acis_filter should put
+# it in: 0 = ACIS-I, 1 = ACIS-S, 2 = hot ACIS, 3 = cold ECS
+acis_filter_cases = [
+    (_obs(1, "ACIS-S", grating="HETG", S3="Y", ccd_count=6,
+          num_counts=1.0e6), 2),
+    (_obs(2, "ACIS-I", grating="HETG", S3="N", ccd_count=4,
+          num_counts=1.0e6), 2),
+    (_obs(3, "ACIS-S", grating="NONE", S3="Y", ccd_count=1,
+          num_counts=100.0), 2),
+    (_obs(4, "ACIS-S", grating="NONE", S3="Y", ccd_count=1,
+          num_counts=1000.0), 1),
+    (_obs(5, "ACIS-S", grating="NONE", S3="Y", ccd_count=2,
+          num_counts=100.0), 1),
+    (_obs(6, "ACIS-I", grating="NONE", S3="N", ccd_count=4,
+          num_counts=100.0), 0),
+    (_obs(7, "ACIS-S", grating="NONE", S3="Y", ccd_count=1,
+          num_counts=np.ma.masked), 1),
+    (_obs(8, "ACIS-S", grating=np.ma.masked, S3="Y", ccd_count=3,
+          num_counts=1000.0), 1),
+    (_obs(9, "ACIS-S"), 1),
+    (_obs(10, "ACIS-I"), 0),
+    (_obs(60001, "HRC-S"), 3),
+]
+
+
+@pytest.mark.parametrize("obs, expected", acis_filter_cases)
+def test_acis_filter(obs, expected):
+    lists = acis_obs.acis_filter([obs])
+    for i, obs_list in enumerate(lists):
+        assert obs_list == ([obs] if i == expected else [])
+
+
+def test_acis_filter_order():
+    obs_list = [obs for obs, _ in acis_filter_cases]
+    lists = acis_obs.acis_filter(obs_list)
+    for i, filtered in enumerate(lists):
+        assert filtered == [obs for obs, expected in acis_filter_cases
+                            if expected == i]
+
+
+def test_acis_filter_empty():
+    assert acis_obs.acis_filter([]) == ([], [], [], [])
+
+
+def test_acis_filter_hrc_science():
+    obs_list = [_obs(1, "ACIS-S"), _obs(2, "HRC-I")]
+    with pytest.raises(RuntimeError, match="limit 2 should have"):
+        acis_obs.acis_filter(obs_list)